@@ -0,0 +1,36 @@
+import asyncio
+import httpx
+import redis.asyncio as redis
+from openai import AsyncOpenAI
+from supabase import AsyncClient, AsyncClientOptions, acreate_client
+from config import settings
+
+config = settings()
+
+# Shared connection pool so every completion reuses keep-alive TCP/TLS sessions;
+# HTTP/2 lets concurrent completions multiplex over one connection
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+# Retries are handled by gpt.request_completion, so the SDK's own retry loop is disabled
+openai_client = AsyncOpenAI(api_key=config.OPENAI_API_KEY, http_client=http_client, max_retries=0)
+redis_client = redis.from_url(config.REDIS_URL, decode_responses=True)
+
+_supabase = None
+_supabase_lock = asyncio.Lock()
+
+async def get_supabase() -> AsyncClient:
+    """Return the shared async Supabase client, creating it on first use inside the running loop."""
+    global _supabase
+    if _supabase is None:
+        # Concurrent first requests would otherwise each build a client with its own connection pool
+        async with _supabase_lock:
+            if _supabase is None:
+                _supabase = await acreate_client(
+                    config.SUPABASE_URL,
+                    config.SUPABASE_KEY,
+                    options=AsyncClientOptions(postgrest_client_timeout=config.SUPABASE_TIMEOUT_SECONDS)
+                )
+    return _supabase
@@ -0,0 +1,40 @@
+import os
+from functools import lru_cache
+from types import SimpleNamespace
+from dotenv import load_dotenv
+
+def per_worker(name, default, workers):
+    """Split an account-wide limit evenly across Uvicorn worker processes, which each enforce their own share."""
+    return max(1, int(os.getenv(name, default)) // workers)
+
+@lru_cache(maxsize=1)
+def settings():
+    """Load .env once and return the app settings."""
+    load_dotenv()
+    # Same variable Uvicorn reads for its worker count
+    workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    return SimpleNamespace(
+        SUPABASE_URL=os.getenv("SUPABASE_URL"),
+        SUPABASE_KEY=os.getenv("SUPABASE_KEY"),
+        OPENAI_API_KEY=os.getenv("OPENAI_API_KEY"),
+        SENDGRID_API_KEY=os.getenv("SENDGRID_API_KEY"),
+        REDIS_URL=redis_url,
+        WEB_CONCURRENCY=workers,
+        REPORT_MODEL=os.getenv("REPORT_MODEL", "gpt-4o"),
+        PRIMARY_MODEL=os.getenv("PRIMARY_MODEL", "gpt-4o-mini"),
+        FALLBACK_MODEL=os.getenv("FALLBACK_MODEL", "gpt-4o"),
+        SUPPLIER_REFRESH_SECONDS=int(os.getenv("SUPPLIER_REFRESH_SECONDS", "300")),
+        # OpenAI and SendGrid limits are configured for the whole deployment and divided per worker
+        OPENAI_MAX_CONCURRENCY=per_worker("OPENAI_MAX_CONCURRENCY", "20", workers),
+        OPENAI_REQUESTS_PER_MINUTE=per_worker("OPENAI_REQUESTS_PER_MINUTE", "500", workers),
+        OPENAI_TOKENS_PER_MINUTE=per_worker("OPENAI_TOKENS_PER_MINUTE", "200000", workers),
+        CORS_ORIGINS=[origin.strip() for origin in os.getenv("CORS_ORIGINS", "*").split(",") if origin.strip()],
+        CHAT_RATE_LIMIT=os.getenv("CHAT_RATE_LIMIT", "30/minute"),
+        # Per-client counters must be shared once there is more than one worker, or each worker grants the full limit
+        RATE_LIMIT_STORAGE_URI=os.getenv("RATE_LIMIT_STORAGE_URI", redis_url if workers > 1 else "memory://"),
+        SENDGRID_MAX_CONCURRENCY=per_worker("SENDGRID_MAX_CONCURRENCY", "10", workers),
+        SUPABASE_TIMEOUT_SECONDS=int(os.getenv("SUPABASE_TIMEOUT_SECONDS", "10")),
+        EXTRACT_CACHE_TTL_SECONDS=int(os.getenv("EXTRACT_CACHE_TTL_SECONDS", "86400")),
+        SESSION_TTL_SECONDS=int(os.getenv("SESSION_TTL_SECONDS", "900")),
+    )
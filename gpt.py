@@ -1,124 +1,320 @@
-import openai
-import os
+import re
 import json
-from dotenv import load_dotenv
+import orjson
+import logging
+import time
+import asyncio
+import hashlib
+from contextvars import ContextVar
+from collections import OrderedDict
+from openai import APIConnectionError, InternalServerError, RateLimitError
+from pydantic import ValidationError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from clients import openai_client
+from config import settings
+from models import ParsedCommand
 
-load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# System prompts are module constants so every request sends a byte-identical prefix,
+# which is what OpenAI's automatic prompt caching matches on
+REPORT_SYSTEM = "You're an expert AI project manager. You analyze project goals, updates, and reports and generate clear structured summaries with phases, tasks, needs, issues, and progress tracking."
+EMAIL_PARSER_SYSTEM = (
+    "You are an email intent parser. For any request to send, write, or compose an email, return ONLY valid JSON in this format: "
+    "{ 'recipient': 'recipient name or email', 'subject': 'Clean subject line', 'message': 'Email body content only' }"
+    "\nStrictly enforce:\n"
+    "- The subject must be a clean, concise subject line. Do NOT start with 'Subject:' and do NOT include any body content.\n"
+    "- The message must contain ONLY the body of the email, and must NOT duplicate or repeat the subject line.\n"
+    "- Do NOT include markdown, commentary, explanations, or any text outside the JSON.\n"
+    "- Example output: { 'recipient': 'John Smith', 'subject': 'Pricing Inquiry', 'message': 'Following up on our discussion about material costs.' }"
+)
+# All drafting instructions live in the system prompt; the user turn carries only the per-request details
+DRAFT_SYSTEM = (
+    "You write emails that are clear and concise.\n"
+    "Draft a short, professional, but friendly email to the given recipient about the given topic.\n"
+    "Include a subject line at the top like this:\n"
+    "Subject: <your subject here>\n\n"
+    "Then add the email message starting with:\n"
+    "Message: <your message here>\n\n"
+    "Do not include any sign-off or sender name."
+)
+DRAFT_PROMPT = "Recipient: {name}\nTopic: {topic}"
 
-def generate_project_report(prompt: str) -> str:
-    """Send prompt to GPT and return structured project report."""
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[
+# Output caps: generation time grows with reply length, and these replies are short by design
+DRAFT_MAX_TOKENS = 400
+DRAFT_TEMPERATURE = 0.5
+PARSED_COMMAND_MAX_TOKENS = 500
+REVISE_SYSTEM = (
+    "Revise the email below per the user's instructions. Keep the same format: "
+    "a 'Subject:' line, then the body starting with 'Message:'. No sign-off or sender name."
+)
+
+DRAFT_RE = re.compile(r"subject:[ \t]*(?P<subject>[^\n]*)\n\s*message:\s*(?P<message>.*)", re.IGNORECASE | re.DOTALL)
+
+logger = logging.getLogger(__name__)
+
+# Callback receiving draft tokens as they stream in; set by /chat-command/stream
+draft_listener = ContextVar("draft_listener", default=None)
+
+# Bounds in-flight OpenAI requests per process so bursts queue here instead of tripping 429s
+openai_slots = asyncio.Semaphore(settings().OPENAI_MAX_CONCURRENCY)
+
+class RateLimiter:
+    """Token bucket over requests and tokens per minute, matching how OpenAI meters an account.
+    Callers wait here for capacity instead of sending requests that would come back as 429s."""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.capacity = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.available = dict(self.capacity)
+        self.updated = time.monotonic()
+        # Held while waiting, so callers are served in arrival order
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        for kind, capacity in self.capacity.items():
+            self.available[kind] = min(capacity, self.available[kind] + capacity * elapsed / 60)
+
+    async def acquire(self, tokens: int):
+        needed = {"requests": 1, "tokens": min(tokens, self.capacity["tokens"])}
+        async with self.lock:
+            while True:
+                self.refill()
+                shortfall = {kind: needed[kind] - self.available[kind] for kind in needed}
+                if all(missing <= 0 for missing in shortfall.values()):
+                    for kind in needed:
+                        self.available[kind] -= needed[kind]
+                    return
+                await asyncio.sleep(max(60 * missing / self.capacity[kind] for kind, missing in shortfall.items()))
+
+def estimate_tokens(params: dict) -> int:
+    """Rough token count for rate limiting: ~4 characters per prompt token plus the reply budget,
+    which OpenAI also counts against the per-minute limit."""
+    prompt_chars = sum(len(message.get("content") or "") for message in params.get("messages", []))
+    return prompt_chars // 4 + params.get("max_tokens", 1000)
+
+openai_limiter = RateLimiter(settings().OPENAI_REQUESTS_PER_MINUTE, settings().OPENAI_TOKENS_PER_MINUTE)
+
+# Rate limits, dropped connections/timeouts (APITimeoutError is an APIConnectionError) and 5xx are transient
+@retry(
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, InternalServerError)),
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+async def request_completion(**params):
+    """Create a chat completion, backing off and retrying on transient failures."""
+    await openai_limiter.acquire(estimate_tokens(params))
+    return await openai_client.chat.completions.create(**params)
+
+def log_usage(model: str, usage) -> None:
+    """Log token usage, including how much of the prompt was served from OpenAI's prefix cache."""
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    logger.debug("%s prompt_tokens=%s cached_tokens=%s", model, usage.prompt_tokens, cached)
+
+def structured_output(model) -> dict:
+    """Build a strict json_schema response_format so replies are validated against a Pydantic model."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": model.__name__,
+            "schema": {**model.model_json_schema(), "additionalProperties": False},
+            "strict": True
+        }
+    }
+
+RESPONSE_CACHE_SIZE = 1024
+_response_cache = OrderedDict()
+# Temperature-0 requests currently being answered, so identical concurrent calls share one completion
+_inflight = {}
+
+async def cached_completion(model: str, messages: list, temperature: float = 0, **kwargs) -> str:
+    """Return the completion text, reusing the stored answer for identical temperature-0 requests."""
+    if temperature != 0:
+        return await complete_text(model=model, messages=messages, temperature=temperature, **kwargs)
+
+    payload = {"model": model, "messages": messages, "temperature": temperature, **kwargs}
+    key = hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    if key in _response_cache:
+        _response_cache.move_to_end(key)
+        return _response_cache[key]
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(fill_response_cache(key, payload))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # Shielded so one caller disconnecting doesn't cancel the answer the others are waiting on
+    return await asyncio.shield(task)
+
+async def fill_response_cache(key: str, payload: dict) -> str:
+    response_text = await complete_text(**payload)
+    _response_cache[key] = response_text
+    if len(_response_cache) > RESPONSE_CACHE_SIZE:
+        _response_cache.popitem(last=False)
+    return response_text
+
+async def complete_text(**params) -> str:
+    async with openai_slots:
+        response = await request_completion(**params)
+    log_usage(params["model"], response.usage)
+    return response.choices[0].message.content
+
+async def structured_completion(schema, messages: list, max_tokens: int):
+    """Return the reply parsed into the schema model, retrying once on FALLBACK_MODEL if the
+    primary model's reply doesn't validate (e.g. it hit max_tokens). Raises pydantic.ValidationError if neither does."""
+    config = settings()
+    # The retry gets twice the budget in case the first reply was cut off rather than malformed
+    for model, limit in ((config.PRIMARY_MODEL, max_tokens), (config.FALLBACK_MODEL, max_tokens * 2)):
+        response_text = await cached_completion(
+            model=model,
+            messages=messages,
+            temperature=0,
+            max_tokens=limit,
+            response_format=structured_output(schema)
+        )
+        try:
+            return schema.model_validate_json(response_text)
+        except ValidationError:
+            if model == config.FALLBACK_MODEL:
+                raise
+            logger.warning("%s reply failed %s validation, retrying on %s", model, schema.__name__, config.FALLBACK_MODEL)
+
+async def stream_completion(**params):
+    """Yield the completion text piece by piece as the model produces it."""
+    async with openai_slots:
+        stream = await request_completion(stream=True, stream_options={"include_usage": True}, **params)
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            elif chunk.usage:
+                log_usage(params.get("model"), chunk.usage)
+
+def report_request(prompt: str) -> dict:
+    """Build the chat completion parameters for a project report."""
+    return {
+        "model": settings().REPORT_MODEL,
+        "messages": [
             {
                 "role": "system",
-                "content": "You're an expert AI project manager. You analyze project goals, updates, and reports and generate clear structured summaries with phases, tasks, needs, issues, and progress tracking."
+                "content": REPORT_SYSTEM
             },
             {
                 "role": "user",
                 "content": prompt
             }
         ],
-        temperature=0.5
+        "temperature": 0.5
+    }
+
+async def stream_project_report(prompt: str):
+    """Stream the structured project report as it is generated."""
+    async for text in stream_completion(**report_request(prompt)):
+        yield text
+
+async def generate_project_report(prompt: str) -> str:
+    """Send prompt to GPT and return structured project report."""
+    return "".join([text async for text in stream_project_report(prompt)])
+
+async def generate_project_reports_batch(prompts: list, poll_interval: float = 60) -> list:
+    """Generate many reports through the Batch API (half price, results within 24h).
+    Returns the report texts in prompt order, with None for any request that failed."""
+    lines = [
+        json.dumps({"custom_id": str(i), "method": "POST", "url": "/v1/chat/completions", "body": report_request(prompt)})
+        for i, prompt in enumerate(prompts)
+    ]
+    batch_file = await openai_client.files.create(file=("reports.jsonl", "\n".join(lines).encode()), purpose="batch")
+    batch = await openai_client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
     )
 
-    return response['choices'][0]['message']['content']
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(poll_interval)
+        batch = await openai_client.batches.retrieve(batch.id)
+
+    if batch.status != "completed":
+        raise RuntimeError(f"Report batch {batch.id} ended with status '{batch.status}'")
 
+    reports = [None] * len(prompts)
+    if batch.output_file_id:
+        output = await openai_client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            result = orjson.loads(line)
+            response = result.get("response")
+            if response and response["status_code"] == 200:
+                reports[int(result["custom_id"])] = response["body"]["choices"][0]["message"]["content"]
+    return reports
 
-def parse_command(prompt: str) -> dict:
+
+async def parse_command(prompt: str) -> dict:
     """Parses a natural language command into structured JSON with keys: recipient, subject, message."""
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    "You are an email intent parser. For any request to send, write, or compose an email, return ONLY valid JSON in this format: "
-                    "{ 'recipient': 'recipient name or email', 'subject': 'Clean subject line', 'message': 'Email body content only' }"\
-                    "\nStrictly enforce:\n"
-                    "- The subject must be a clean, concise subject line. Do NOT start with 'Subject:' and do NOT include any body content.\n"
-                    "- The message must contain ONLY the body of the email, and must NOT duplicate or repeat the subject line.\n"
-                    "- Do NOT include markdown, commentary, explanations, or any text outside the JSON.\n"
-                    "- Example output: { 'recipient': 'John Smith', 'subject': 'Pricing Inquiry', 'message': 'Following up on our discussion about material costs.' }"
-                )
-            },
-            {
-                "role": "user",
-                "content": prompt
-            }
-        ],
-        temperature=0.1
-    )
+    parsed = await structured_completion(ParsedCommand, [
+        {
+            "role": "system",
+            "content": EMAIL_PARSER_SYSTEM
+        },
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ], max_tokens=PARSED_COMMAND_MAX_TOKENS)
+    return parsed.model_dump()
 
-    response_text = response['choices'][0]['message']['content'].strip()
-    
-    try:
-        return json.loads(response_text)
-    except json.JSONDecodeError as e:
-        # Fallback: try to extract JSON from response if wrapped in markdown or extra text
-        import re
-        json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-        if json_match:
-            try:
-                return json.loads(json_match.group())
-            except json.JSONDecodeError:
-                pass
-        
-        # If all parsing fails, return error structure
-        raise ValueError(f"Failed to parse JSON response from GPT: {response_text}")
-    except Exception as e:
-        raise ValueError(f"Error processing GPT response: {str(e)}")
+DRAFT_CACHE_SIZE = 512
+_draft_cache = OrderedDict()
 
 async def generate_email_draft(name: str, topic: str) -> dict:
-    """Generate an email draft with a clean subject and message body.
-    Returns a dict with 'subject' and 'message' keys."""
-    prompt = f"""
-    Create a professional email to {name} about: {topic}
-    Return ONLY a JSON object with exactly these fields:
-    - subject: A short, clean subject line (no 'Subject:' prefix)
-    - message: The email body content only
-    """
-    
-    try:
-        result = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are an email drafting assistant. Return ONLY a valid JSON object with exactly two fields:\n"
-                        "1. 'subject': A short, clean subject line for the email header. Do not include 'Subject:' prefix.\n"
-                        "2. 'message': The email body content only. Do not repeat the subject.\n"
-                        "Example: {\"subject\": \"Project Update Meeting\", \"message\": \"I hope this email finds you well...\"}\n"
-                        "Do not include any other text, markdown, or formatting outside the JSON object."
-                    )
-                },
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7
-        )
-        
-        response_text = result.choices[0].message.content.strip()
-        parsed = json.loads(response_text)
-        
-        # Validate the response has required fields
-        if not isinstance(parsed, dict) or 'subject' not in parsed or 'message' not in parsed:
-            raise ValueError("Invalid response format")
-            
-        # Clean up the subject if it has 'Subject:' prefix
-        subject = parsed['subject']
-        if subject.lower().startswith('subject:'):
-            subject = subject[8:].strip()
-            
-        return {
-            'subject': subject,
-            'message': parsed['message']
-        }
-        
-    except (json.JSONDecodeError, ValueError, KeyError, AttributeError) as e:
-        # Fallback to default template if parsing fails
-        return {
-            'subject': f"Follow-up: {topic}",
-            'message': f"Dear {name},\n\nI hope this email finds you well. I wanted to follow up regarding {topic}.\n\nBest regards"
-        }
+    """Draft an email to name about topic. Returns a dict with 'subject' and 'message' keys.
+    Drafts are remembered per (name, topic); changes go through revise_email_draft."""
+    # Case and spacing don't change the email, so "Acme"/"acme " share an entry
+    key = (" ".join(name.lower().split()), " ".join(topic.lower().split()))
+    if key in _draft_cache:
+        _draft_cache.move_to_end(key)
+        draft = _draft_cache[key]
+        listener = draft_listener.get()
+        if listener:
+            listener(f"Subject: {draft['subject']}\nMessage: {draft['message']}")
+        return dict(draft)
+
+    draft = await write_email_draft([
+        {"role": "system", "content": DRAFT_SYSTEM},
+        {"role": "user", "content": DRAFT_PROMPT.format(name=name, topic=topic)}
+    ])
+    if draft["message"]:
+        _draft_cache[key] = draft
+        if len(_draft_cache) > DRAFT_CACHE_SIZE:
+            _draft_cache.popitem(last=False)
+    return dict(draft)
+
+async def revise_email_draft(session: dict, instructions: str) -> dict:
+    """Edit the session's current draft per the user's instructions instead of writing a new one."""
+    return await write_email_draft([
+        {"role": "system", "content": REVISE_SYSTEM},
+        {"role": "assistant", "content": f"Subject: {session.get('draft_subject', '')}\nMessage: {session['draft']}"},
+        {"role": "user", "content": instructions}
+    ])
+
+async def write_email_draft(messages: list) -> dict:
+    """Stream a Subject:/Message: draft to any draft_listener and parse it once complete."""
+    listener = draft_listener.get()
+    chunks = []
+    async for text in stream_completion(
+        model=settings().PRIMARY_MODEL,
+        messages=messages,
+        max_tokens=DRAFT_MAX_TOKENS,
+        temperature=DRAFT_TEMPERATURE
+    ):
+        chunks.append(text)
+        if listener:
+            listener(text)
+
+    response = "".join(chunks).strip()
+    match = DRAFT_RE.search(response)
+    if not match:
+        # The model skipped the format; show what it wrote rather than an empty draft
+        return {"subject": "", "message": response}
+    return {"subject": match["subject"].strip(), "message": match["message"].strip()}
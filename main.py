@@ -1,56 +1,402 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional
-from uuid import uuid4
-import os
-import requests
-import json
-import traceback
-from dotenv import load_dotenv
-from supabase import create_client
-from openai import OpenAI
-import sendgrid
-from sendgrid.helpers.mail import Mail
-
-# Load environment variables
-load_dotenv()
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
-
-# Initialize clients
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-sg = sendgrid.SendGridAPIClient(api_key=SENDGRID_API_KEY)
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, ValidationError
+from contextlib import asynccontextmanager, suppress
+import re
+import asyncio
+import hashlib
+import orjson
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import httpx
+from openai import APIError, RateLimitError
+from postgrest.exceptions import APIError as PostgrestError
+from cachetools import TTLCache
+from rapidfuzz import fuzz, process
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+from config import settings
+from clients import get_supabase, http_client, openai_client, redis_client
+from gpt import (
+    draft_listener,
+    generate_email_draft,
+    revise_email_draft,
+    structured_completion,
+)
+from models import ExtractedRequest
+
+config = settings()
+
+# Log records are handed to a background thread so the stderr write stays off the event loop.
+# QueueHandler still formats each record (traceback included) on the calling thread.
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+logger = logging.getLogger(__name__)
+
+# Failures from the services a turn depends on, reported as 502 rather than a server bug
+UPSTREAM_ERRORS = (APIError, httpx.HTTPError, PostgrestError)
+
+# Status and user-facing message per upstream failure, most specific first.
+# RateLimitError has already been retried with backoff by the time it gets here.
+UPSTREAM_FAILURES = [
+    (RateLimitError, 429, "The assistant is busy right now. Please try again in a minute."),
+    (APIError, 502, "The language model is temporarily unavailable. Please try again."),
+    (PostgrestError, 502, "The supplier database is temporarily unavailable. Please try again."),
+    (httpx.HTTPError, 502, "An upstream service is temporarily unavailable. Please try again."),
+]
+
+async def warm_up():
+    """Open the OpenAI and Redis connections before the first user request has to wait on them.
+    Supabase is warmed by the first supplier refresh, which starts alongside this. Runs in the
+    background so a slow provider never delays the worker accepting traffic."""
+    results = await asyncio.gather(openai_client.models.list(), redis_client.ping(), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning("Connection warm-up failed: %s", result)
+
+@asynccontextmanager
+async def lifespan(app):
+    log_listener.start()
+    app.state.supplier_refresh = asyncio.create_task(refresh_suppliers())
+    run_in_background(warm_up())
+    yield
+    # Let in-flight work finish with the pools still open: stop the refresh loop, give pending
+    # background tasks (supplier inserts, warm-up) a moment, then close the clients
+    app.state.supplier_refresh.cancel()
+    with suppress(asyncio.CancelledError):
+        await app.state.supplier_refresh
+    if background_tasks:
+        await asyncio.wait(background_tasks, timeout=5)
+    await http_client.aclose()
+    await redis_client.aclose()
+    log_listener.stop()
 
 # FastAPI setup
-app = FastAPI()
+# orjson serializes the response dicts faster than the stdlib encoder FastAPI defaults to
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+def client_address(request):
+    """Rate-limit key: the caller's address as seen by Render's proxy.
+    The proxy appends the address it received the connection from to X-Forwarded-For, so only the
+    rightmost hop is trustworthy; anything to its left is whatever the client chose to send."""
+    forwarded = request.headers.get("x-forwarded-for")
+    if forwarded:
+        return forwarded.rsplit(",", 1)[-1].strip()
+    return get_remote_address(request)
+
+# Per-client cap so one noisy caller can't use up the OpenAI and SendGrid quotas for everyone.
+# Keyed on client_address, since behind the proxy every request would otherwise share its address.
+limiter = Limiter(key_func=client_address, storage_uri=config.RATE_LIMIT_STORAGE_URI)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=config.CORS_ORIGINS,
+    # Credentials can't be combined with a wildcard origin, so they're only allowed for an explicit list
+    allow_credentials="*" not in config.CORS_ORIGINS,
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Authorization"],
+    # Browsers cache the preflight for a day instead of sending OPTIONS before every POST
+    max_age=86400,
 )
 
 class CommandInput(BaseModel):
+    model_config = ConfigDict(frozen=True, str_strip_whitespace=True)
+
     session_id: str
     message: str
 
-sessions = {}
+SENDGRID_SEND_URL = "https://api.sendgrid.com/v3/mail/send"
+sendgrid_slots = asyncio.Semaphore(config.SENDGRID_MAX_CONCURRENCY)
+
+def is_retryable_send_error(error):
+    # Only failures where SendGrid can't have accepted the mail, so a retry never sends it twice
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return True
+    return isinstance(error, httpx.HTTPStatusError) and error.response.status_code in (429, 502, 503)
+
+# Calls SendGrid's v3 API over the shared pool instead of the blocking SDK and its own connections
+@retry(
+    retry=retry_if_exception(is_retryable_send_error),
+    wait=wait_random_exponential(min=1, max=8),
+    stop=stop_after_attempt(4),
+    reraise=True
+)
+async def send_email(from_email, to_email, subject, body):
+    async with sendgrid_slots:
+        response = await http_client.post(
+            SENDGRID_SEND_URL,
+            headers={"Authorization": f"Bearer {config.SENDGRID_API_KEY}"},
+            json={
+                "personalizations": [{"to": [{"email": to_email}]}],
+                "from": {"email": from_email},
+                "subject": subject,
+                "content": [{"type": "text/plain", "value": body}]
+            }
+        )
+    response.raise_for_status()
+
+# Chat sessions live in Redis so they are shared across workers and expire when abandoned
+async def get_session(session_id):
+    raw = await redis_client.get(f"sess:{session_id}")
+    return orjson.loads(raw) if raw else {}
+
+async def save_session(session_id, session):
+    await redis_client.set(f"sess:{session_id}", orjson.dumps(session), ex=config.SESSION_TTL_SECONDS)
+
+async def delete_session(session_id, session):
+    # Any unreported supplier-save failure goes with the session, so it can't surface on a later send
+    await redis_client.delete(f"sess:{session_id}", supplier_save_failed_key(session_id, session["recipient"]["email"]))
+
+# In-process copy of the suppliers table, matched locally instead of querying Supabase per turn
+suppliers_cache = []
+supplier_names = []
+
+# Only the supplier columns the chat flow uses
+SUPPLIER_COLUMNS = "id,name,email,material"
+# Options shown for an ambiguous name; lookups fetch one extra row to know if there were more
+MAX_SUPPLIER_OPTIONS = 10
+
+# Short-lived caches for the Supabase reads that remain on the request path
+supplier_lookup_cache = TTLCache(maxsize=1024, ttl=60)
+user_emails_cache = TTLCache(maxsize=1, ttl=60)
+# Lets concurrent requests that miss the cache share one query instead of each issuing their own
+user_emails_lock = asyncio.Lock()
+
+# Speculative drafts kept while the user picks a sender, by session, as (task, HeldTokens)
+pending_drafts = TTLCache(maxsize=1024, ttl=config.SESSION_TTL_SECONDS)
+
+class HeldTokens:
+    """Buffers tokens from a speculative draft until release() hands them to a listener."""
+
+    def __init__(self):
+        self.tokens = []
+        self.listener = None
+
+    def __call__(self, token):
+        if self.listener:
+            self.listener(token)
+        else:
+            self.tokens.append(token)
+
+    def release(self, listener):
+        for token in self.tokens:
+            listener(token)
+        self.tokens = []
+        self.listener = listener
+
+# System prompts are constants so repeated calls share a byte-identical, cacheable prefix
+EXTRACT_SYSTEM = (
+    "Extract the supplier name, email (if any), and topic from the user's request.\n"
+    "Respond in JSON with keys: \"recipient_name\", \"recipient_email\", and \"topic\". "
+    "Use an empty string for an email that isn't given."
+)
+
+# Confirmation keywords, matched against whole words so "no" doesn't fire on "now" or "another"
+YES_RE = re.compile(r"\b(?:yes|y|yep|yeah|okay|ok|sure|approved?|send|go ahead)\b")
+# Every word an approval may be made of ("yes, send it now please", "looks good, go ahead")
+APPROVAL_WORDS = frozenset({
+    "yes", "y", "yep", "yeah", "okay", "ok", "sure", "approve", "approved", "send",
+    "go", "ahead", "it", "now", "please", "thanks", "thank", "you", "that", "this", "the", "email",
+    "looks", "sounds", "good", "great", "fine", "perfect"
+})
+NO_WORDS = frozenset({"no", "n", "change", "redo", "edit", "revise"})
+# Any of these stops a reply from counting as approval ("no, don't send it yet", "ok but not yet")
+HOLD_WORDS = frozenset({"not", "dont", "wait", "hold", "stop", "later", "cancel", "never", "yet"})
+# Words that carry no revision guidance on their own ("no thanks", "please change it")
+FILLER_WORDS = frozenset({"please", "thanks", "thank", "you", "it", "that", "this", "really", "but"})
+WORD_RE = re.compile(r"[a-z']+")
+
+def is_hold(words):
+    return bool(words & HOLD_WORDS) or any(word.endswith("n't") for word in words)
+
+def is_approval(message, words):
+    # Only an unambiguous reply sends: "send it to John instead" or "yes but shorter" must not
+    return bool(YES_RE.search(message)) and words <= APPROVAL_WORDS
+
+def has_instructions(words):
+    # "doesn't mention the price" is guidance; "no, don't send it yet" is not
+    vocabulary = APPROVAL_WORDS | NO_WORDS | HOLD_WORDS | FILLER_WORDS
+    return any(word not in vocabulary and not word.endswith("n't") for word in words)
+
+# Name, address and a topic phrase fit comfortably; a longer reply means the model is rambling
+EXTRACT_MAX_TOKENS = 120
+
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+
+# Common phrasings ("send an email to X about Y") that can be parsed without a GPT call
+REQUEST_LEAD_IN = r"(?:(?:can|could|would)\s+you\s+)?(?:please\s+)?"
+REQUEST_PATTERNS = [
+    re.compile(
+        REQUEST_LEAD_IN + r"(?:send|write|compose|draft)\s+(?:an?\s+)?(?:email|message|note)\s+to\s+"
+        r"(?P<name>\S[^\n]{0,60}?)\s+(?:about|regarding|re:)\s+(?P<topic>\S.*)",
+        re.IGNORECASE | re.DOTALL
+    ),
+    re.compile(
+        REQUEST_LEAD_IN + r"(?:email|message|contact|reach out)\s+(?:to\s+)?"
+        r"(?P<name>\S[^\n]{0,60}?)\s+(?:about|regarding|re:)\s+(?P<topic>\S.*)",
+        re.IGNORECASE | re.DOTALL
+    ),
+]
+
+def load_suppliers(rows):
+    global suppliers_cache, supplier_names
+    suppliers_cache = rows
+    supplier_names = [(row.get("name") or "").lower() for row in rows]
+
+# PostgREST caps each response (max-rows, 1000 by default on Supabase), so the full table is read in pages
+SUPPLIER_PAGE_SIZE = 1000
+
+async def fetch_all_suppliers():
+    supabase = await get_supabase()
+    rows = []
+    while True:
+        start = len(rows)
+        # Ordered by id so pages don't overlap or skip rows between requests
+        page = (await supabase.table("suppliers").select(SUPPLIER_COLUMNS).order("id")
+                .range(start, start + SUPPLIER_PAGE_SIZE - 1).execute()).data
+        # Stop on an empty page rather than a short one, in case max-rows is set below the page size
+        if not page:
+            return rows
+        rows.extend(page)
+
+async def refresh_suppliers():
+    while True:
+        try:
+            load_suppliers(await fetch_all_suppliers())
+        except Exception:
+            logger.exception("Supplier refresh failed")
+        await asyncio.sleep(config.SUPPLIER_REFRESH_SECONDS)
+
+async def find_suppliers(name, email):
+    if not suppliers_cache:
+        # Cache not loaded yet: fall back to querying Supabase directly
+        key = (name.lower(), email.lower())
+        rows = supplier_lookup_cache.get(key)
+        if rows is None:
+            supabase = await get_supabase()
+            if email:
+                query = supabase.table("suppliers").select(SUPPLIER_COLUMNS).eq("email", email).limit(1)
+            else:
+                # Trigram-ranked, so the closest names come first in the ambiguity list
+                query = supabase.rpc("search_suppliers", {"q": name, "max_results": MAX_SUPPLIER_OPTIONS + 1})
+            rows = (await query.execute()).data
+            supplier_lookup_cache[key] = rows
+        return rows
+
+    if email:
+        # An address identifies one supplier, so stop at the first hit
+        email = email.lower()
+        match = next((row for row in suppliers_cache if (row.get("email") or "").lower() == email), None)
+        return [match] if match else []
+    matches = process.extract(name.lower(), supplier_names, scorer=fuzz.partial_ratio, score_cutoff=70, limit=MAX_SUPPLIER_OPTIONS + 1)
+    return [suppliers_cache[index] for _, _, index in matches]
+
+# Strong references to fire-and-forget tasks, which the event loop would otherwise only hold weakly
+background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Supplier inserts still in flight, by email, so a quick second request for the same address doesn't insert it twice
+pending_supplier_inserts = {}
+
+# How long sending waits for a still-running insert, so its outcome can make the "sent" reply
+SUPPLIER_SAVE_WAIT_SECONDS = 3
+
+def supplier_save_failed_key(session_id, email):
+    return f"supplier_save_failed:{session_id}:{email}"
+
+def is_retryable_supplier_error(error):
+    # Dropped connections, timeouts and 5xx; constraint or permission errors would only fail again
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, PostgrestError):
+        # Non-JSON error bodies (gateway failures) carry the HTTP status; PGRST000-003 are
+        # PostgREST losing its database connection
+        if isinstance(error.code, int):
+            return error.code >= 500
+        return error.code in ("PGRST000", "PGRST001", "PGRST002", "PGRST003")
+    return False
+
+@retry(
+    retry=retry_if_exception(is_retryable_supplier_error),
+    wait=wait_random_exponential(min=1, max=8),
+    stop=stop_after_attempt(3),
+    reraise=True
+)
+async def insert_supplier(new_supplier):
+    supabase = await get_supabase()
+    # A timed-out attempt may still have landed, so look before inserting again
+    existing = await supabase.table("suppliers").select(SUPPLIER_COLUMNS).eq("email", new_supplier["email"]).limit(1).execute()
+    if existing.data:
+        return []
+    inserted = await supabase.table("suppliers").insert(new_supplier).execute()
+    return inserted.data
+
+async def save_new_supplier(session_id, new_supplier):
+    failed_key = supplier_save_failed_key(session_id, new_supplier["email"])
+    try:
+        # A failure left over from an earlier attempt at this address no longer applies
+        await redis_client.delete(failed_key)
+        inserted = await insert_supplier(new_supplier)
+        supplier_lookup_cache.clear()
+        if suppliers_cache:
+            load_suppliers(suppliers_cache + inserted)
+    except UPSTREAM_ERRORS:
+        logger.exception("Saving new supplier %s failed", new_supplier["email"])
+        # The reply for this turn has already gone out, so tell the user when the email is sent
+        await redis_client.set(failed_key, new_supplier["email"], ex=config.SESSION_TTL_SECONDS)
+    finally:
+        pending_supplier_inserts.pop(new_supplier["email"], None)
+
+async def get_user_emails():
+    emails = user_emails_cache.get("emails")
+    if emails is not None:
+        return emails
+    async with user_emails_lock:
+        emails = user_emails_cache.get("emails")
+        if emails is None:
+            supabase = await get_supabase()
+            resp = await supabase.table("user_emails").select("email").execute()
+            emails = [e["email"] for e in resp.data]
+            user_emails_cache["emails"] = emails
+    return emails
 
 @app.get("/health")
 async def health():
     return {"status": "ok"}
 
 @app.post("/chat-command")
-async def chat_command(data: CommandInput):
+@limiter.limit(config.CHAT_RATE_LIMIT)
+async def chat_command(request: Request, data: CommandInput):
+    return await run_chat_command(data)
+
+# Turns currently being processed, so a double-submitted message joins the first run instead of repeating it
+inflight_commands = {}
+
+async def run_chat_command(data):
+    key = hashlib.sha256(f"{data.session_id}\0{data.message}".encode()).hexdigest()
+    task = inflight_commands.get(key)
+    if task is None:
+        task = asyncio.create_task(process_chat_command(data))
+        inflight_commands[key] = task
+        task.add_done_callback(lambda _: inflight_commands.pop(key, None))
+    # Shielded so the first caller disconnecting doesn't abort the turn for the duplicate
+    return await asyncio.shield(task)
+
+async def process_chat_command(data):
     try:
         session_id = data.session_id
         message = data.message.strip().lower()
-        session = sessions.get(session_id, {})
+        session = await get_session(session_id)
         state = session.get("state", "start")
 
         if state == "awaiting_user_email_choice":
@@ -60,32 +406,84 @@ async def chat_command(data: CommandInput):
             return await handle_recipient_choice(session_id, message, session)
 
         if state == "awaiting_confirmation":
-            return await handle_confirmation(session_id, message, session)
+            return await handle_confirmation(session_id, message, session, data.message.strip())
 
         return await handle_new_request(session_id, data.message)
 
-    except Exception as e:
-        traceback.print_exc()
-        return {"status": "error", "message": f"Something went wrong: {str(e)}"}
+    except UPSTREAM_ERRORS as e:
+        # Expected outages: one log line, not a traceback per failed turn
+        status_code, detail = next((code, text) for kind, code, text in UPSTREAM_FAILURES if isinstance(e, kind))
+        logger.warning("chat_command upstream failure session=%s: %s: %s", data.session_id, type(e).__name__, e)
+        raise HTTPException(status_code=status_code, detail=detail)
+    except Exception:
+        logger.exception("chat_command failed session=%s", data.session_id)
+        raise HTTPException(status_code=500, detail="Something went wrong.")
+
+# Same as /chat-command, but streams draft tokens as SSE "token" events before the final "result" event
+@app.post("/chat-command/stream")
+@limiter.limit(config.CHAT_RATE_LIMIT)
+async def chat_command_stream(request: Request, data: CommandInput):
+    queue = asyncio.Queue()
+    token = draft_listener.set(queue.put_nowait)
+    task = asyncio.create_task(run_chat_command(data))
+    draft_listener.reset(token)
+    task.add_done_callback(lambda _: queue.put_nowait(None))
+
+    async def events():
+        while (text := await queue.get()) is not None:
+            yield f"event: token\ndata: {orjson.dumps(text).decode()}\n\n"
+        try:
+            result = task.result()
+        except HTTPException as e:
+            # Headers are already sent, so the failure goes out as the result event
+            result = {"status": "error", "message": e.detail}
+        yield f"event: result\ndata: {orjson.dumps(result).decode()}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+def pick_choice(message, choices):
+    """Resolve a reply to an index into choices: its list number, an exact match, or a unique partial match."""
+    # isdecimal, not isdigit: "²" is a digit but int() rejects it
+    if message.isdecimal():
+        index = int(message) - 1
+        return index if 0 <= index < len(choices) else None
+    lowered = [choice.lower() for choice in choices]
+    exact = {choice: i for i, choice in enumerate(lowered)}
+    if message in exact:
+        return exact[message]
+    partial = [i for i, choice in enumerate(lowered) if message in choice]
+    return partial[0] if len(partial) == 1 else None
+
+def numbered(items):
+    return "\n".join([f"{i+1}. {item}" for i, item in enumerate(items)])
 
 async def handle_email_choice(session_id, message, session):
     user_emails = session["user_emails"]
-    matched = next((e for e in user_emails if message in e.lower()), None)
+    index = pick_choice(message, user_emails)
 
-    if not matched:
-        email_list = "\n".join([f"- {e}" for e in user_emails])
+    if index is None:
+        email_list = numbered(user_emails)
         return {
             "status": "awaiting_user_email_choice",
             "message": f"Invalid choice. Please reply with one of:\n{email_list}",
             "options": user_emails
         }
 
-    session["chosen_user_email"] = matched
+    session["chosen_user_email"] = user_emails[index]
 
-    parsed = await generate_email_draft(session["recipient"]["name"], session["topic"])
+    kept = pending_drafts.pop(session_id, None)
+    if kept:
+        draft_task, held = kept
+        listener = draft_listener.get()
+        if listener:
+            held.release(listener)
+        parsed = await draft_task
+    else:
+        parsed = await generate_email_draft(session["recipient"]["name"], session["topic"])
     session["draft"] = parsed["message"]
+    session["draft_subject"] = parsed["subject"]
     session["state"] = "awaiting_confirmation"
-    sessions[session_id] = session
+    await save_session(session_id, session)
 
     return {
         "status": "awaiting_confirmation",
@@ -96,28 +494,26 @@ async def handle_email_choice(session_id, message, session):
 
 async def handle_recipient_choice(session_id, message, session):
     options = session.get("options", [])
-    chosen = next((o for o in options if message == o["name"].lower()), None)
-    if not chosen:
-        chosen = next((o for o in options if message in o["name"].lower()), None)
+    index = pick_choice(message, [o["name"] for o in options])
 
-    if not chosen:
-        options_text = "\n".join([f"{i+1}. {o['name']}" for i, o in enumerate(options)])
+    if index is None:
+        options_text = numbered([o["name"] for o in options])
         return {
             "status": "ambiguous",
             "message": f"I found multiple matches\n{options_text}",
             "options": options
         }
 
+    chosen = options[index]
     session["recipient"] = chosen
 
-    user_emails_resp = supabase.table("user_emails").select("email").execute()
-    user_emails = [e["email"] for e in user_emails_resp.data]
+    user_emails = await get_user_emails()
 
     if len(user_emails) > 1:
-        email_list = "\n".join([f"- {e}" for e in user_emails])
+        email_list = numbered(user_emails)
         session["state"] = "awaiting_user_email_choice"
         session["user_emails"] = user_emails
-        sessions[session_id] = session
+        await save_session(session_id, session)
         return {
             "status": "awaiting_user_email_choice",
             "message": f"Multiple sender emails found.\n{email_list}",
@@ -130,8 +526,9 @@ async def handle_recipient_choice(session_id, message, session):
 
     parsed = await generate_email_draft(chosen["name"], session["topic"])
     session["draft"] = parsed["message"]
+    session["draft_subject"] = parsed["subject"]
     session["state"] = "awaiting_confirmation"
-    sessions[session_id] = session
+    await save_session(session_id, session)
 
     return {
         "status": "awaiting_confirmation",
@@ -140,65 +537,116 @@ async def handle_recipient_choice(session_id, message, session):
         "recipient_email": chosen["email"]
     }
 
-async def handle_confirmation(session_id, message, session):
-    message = message.lower()
+async def handle_confirmation(session_id, message, session, raw_message):
+    message = message.lower().replace("\u2019", "'")
+    words = set(WORD_RE.findall(message))
 
-    if any(word in message for word in ["yes", "okay", "go ahead", "send", "sure", "approve"]):
+    # Approval is checked first so a "yes" after a bare "no" still sends
+    if is_approval(message, words) and not is_hold(words):
         recipient = session["recipient"]
         from_email = session.get("chosen_user_email")
 
         if not from_email:
             return {"status": "error", "message": "Missing sender email."}
 
-        parsed = await generate_email_draft(recipient["name"], session["topic"])
-        email = Mail(
-            from_email=from_email,
-            to_emails=recipient["email"],
-            subject=parsed["subject"],
-            plain_text_content=parsed["message"]
-        )
-
+        # Send exactly what the user approved rather than drafting it again
         try:
-            sg.send(email)
-        except Exception as e:
+            await send_email(from_email, recipient["email"], session.get("draft_subject", ""), session["draft"])
+        except httpx.HTTPError as e:
+            logger.warning("SendGrid send failed session=%s: %s", session_id, e)
             return {"status": "error", "message": f"Failed to send email: {str(e)}"}
 
-        sessions.pop(session_id, None)
+        # An insert for this recipient may still be retrying; give it a moment so a failure isn't missed
+        pending_insert = pending_supplier_inserts.get(recipient["email"])
+        if pending_insert:
+            await asyncio.wait({pending_insert}, timeout=SUPPLIER_SAVE_WAIT_SECONDS)
+        unsaved_email = await redis_client.get(supplier_save_failed_key(session_id, recipient["email"]))
+        await delete_session(session_id, session)
+        if unsaved_email:
+            return {
+                "status": "sent",
+                "message": f"Email sent successfully. Note: I couldn't save {unsaved_email} to your suppliers, so it won't be suggested next time."
+            }
         return {"status": "sent", "message": "Email sent successfully."}
 
-    elif any(word in message for word in ["no", "change", "redo", "edit", "revise"]):
-        parsed = await generate_email_draft(session["recipient"]["name"], session["topic"])
-        session["draft"] = parsed["message"]
-        sessions[session_id] = session
+    if not has_instructions(words):
+        if is_hold(words):
+            return {
+                "status": "awaiting_confirmation",
+                "message": "Okay, I won't send it yet. Reply 'yes' when it's ready, or tell me what to change."
+            }
+        # A bare "no" gives the model nothing to act on, so ask instead of paying for a rewrite
+        if words & NO_WORDS:
+            return {"status": "awaiting_confirmation", "message": "What would you like me to change?"}
         return {
             "status": "awaiting_confirmation",
-            "message": parsed["message"],
-            "recipient": session["recipient"]["name"]
+            "message": "Should I send this email? Reply with 'yes' or 'no'."
         }
 
+    # Anything else is a change to make, negations included ("make it shorter and don't mention the deadline")
+    parsed = await revise_email_draft(session, raw_message)
+    session["draft"] = parsed["message"]
+    session["draft_subject"] = parsed["subject"]
+    await save_session(session_id, session)
     return {
         "status": "awaiting_confirmation",
-        "message": "Should I send this email? Reply with 'yes' or 'no'."
+        "message": parsed["message"],
+        "recipient": session["recipient"]["name"]
     }
 
-async def handle_new_request(session_id, raw_message):
-    extract_prompt = f"""
-    Extract the supplier name, email (if any), and topic from this user request. 
-    Respond in JSON with keys: \"recipient_name\", \"recipient_email\", and \"topic\".
-
-    User request: \"{raw_message}\"
-    """
-    response = openai_client.chat.completions.create(
-        model="gpt-4",
-        messages=[
-            {"role": "system", "content": "Extract supplier name, email (optional), and topic."},
-            {"role": "user", "content": extract_prompt}
-        ]
-    )
+def match_request(raw_message):
+    for pattern in REQUEST_PATTERNS:
+        match = pattern.match(raw_message.strip())
+        if not match:
+            continue
+        name, email = match["name"], ""
+        email_match = EMAIL_RE.search(name)
+        if email_match:
+            # "John Smith <john@acme.com>" -> name and address; a bare address still needs GPT for the name
+            email = email_match.group()
+            name = (name[:email_match.start()] + name[email_match.end():]).strip(" ()<>,-")
+        if name and "@" not in name:
+            return {"recipient_name": name, "recipient_email": email, "topic": match["topic"]}
+    return None
+
+# Anything that changes the extraction is part of the key, so a new prompt, model or schema
+# doesn't keep serving extractions other workers cached under the old one
+EXTRACT_FINGERPRINT = hashlib.sha256(orjson.dumps(
+    [EXTRACT_SYSTEM, ExtractedRequest.model_json_schema(), config.FALLBACK_MODEL, EXTRACT_MAX_TOKENS]
+)).hexdigest()[:12]
+EXTRACT_CACHE_PREFIX = f"extract:v1:{config.PRIMARY_MODEL}:{EXTRACT_FINGERPRINT}:"
+
+def extract_cache_key(raw_message):
+    # Spacing doesn't change what's being asked, so "Email  John about pricing" reuses "Email John about pricing".
+    # Case is kept because the cached name and topic are echoed back to the user as written.
+    normalized = " ".join(raw_message.split())
+    return EXTRACT_CACHE_PREFIX + hashlib.sha256(normalized.encode()).hexdigest()
+
+async def extract_request(raw_message):
+    extracted = match_request(raw_message)
+    if extracted is not None:
+        return extracted
+
+    # Shared across workers and restarts, unlike the in-process completion cache
+    cache_key = extract_cache_key(raw_message)
+    cached = await redis_client.get(cache_key)
+    if cached:
+        return orjson.loads(cached)
 
     try:
-        extracted = json.loads(response.choices[0].message.content.strip())
-    except Exception:
+        extracted = await structured_completion(ExtractedRequest, [
+            {"role": "system", "content": EXTRACT_SYSTEM},
+            {"role": "user", "content": " ".join(raw_message.split())}
+        ], max_tokens=EXTRACT_MAX_TOKENS)
+    except ValidationError:
+        return None
+    extracted = extracted.model_dump()
+    await redis_client.set(cache_key, orjson.dumps(extracted), ex=config.EXTRACT_CACHE_TTL_SECONDS)
+    return extracted
+
+async def handle_new_request(session_id, raw_message):
+    extracted = await extract_request(raw_message)
+    if extracted is None:
         return {"status": "error", "message": "Failed to extract supplier info from your message."}
 
     name = extracted.get("recipient_name", "").strip()
@@ -208,18 +656,39 @@ async def handle_new_request(session_id, raw_message):
     if not name:
         return {"status": "error", "message": "No supplier name found in your request."}
 
-    if email:
-        people = supabase.table("suppliers").select("*").eq("email", email).execute().data
-    else:
-        people = supabase.table("suppliers").select("*").ilike("name", f"%{name}%").execute().data
+    # A new request replaces whatever the previous one was still drafting
+    stale = pending_drafts.pop(session_id, None)
+    if stale:
+        stale[0].cancel()
+
+    # The draft only needs the name and topic, so write it while the supplier lookup runs.
+    # Its tokens are held back until we know the draft will actually be shown.
+    held = HeldTokens()
+    token = draft_listener.set(held)
+    draft_task = asyncio.create_task(generate_email_draft(name, topic))
+    draft_listener.reset(token)
+    try:
+        return await resolve_new_request(session_id, name, email, topic, draft_task, held)
+    finally:
+        # No-op once the draft has been used or kept for the sender choice; drops it on the
+        # ambiguous/not-found paths
+        if pending_drafts.get(session_id, (None, None))[0] is not draft_task:
+            draft_task.cancel()
+
+async def resolve_new_request(session_id, name, email, topic, draft_task, held):
+    # The sender list doesn't depend on which supplier matches, so fetch both together
+    people, user_emails = await asyncio.gather(find_suppliers(name, email), get_user_emails())
 
     if not people and email:
-        new_supplier = {"name": name, "email": email}
-        inserted = supabase.table("suppliers").insert(new_supplier).execute()
-        recipient = inserted.data[0]
+        # The draft only needs the name and address, so don't hold the reply for the insert
+        recipient = {"name": name, "email": email}
+        if email not in pending_supplier_inserts:
+            pending_supplier_inserts[email] = run_in_background(save_new_supplier(session_id, dict(recipient)))
     elif not people:
         return {"status": "not_found", "message": f"No suppliers found for '{name}'."}
     elif len(people) > 1:
+        more = len(people) > MAX_SUPPLIER_OPTIONS
+        people = people[:MAX_SUPPLIER_OPTIONS]
         options = [
             {
                 "id": supplier["id"],
@@ -229,13 +698,15 @@ async def handle_new_request(session_id, raw_message):
             }
             for supplier in people
         ]
-        options_text = "\n".join([f"{i+1}. {supplier['name']}" for i, supplier in enumerate(people)])
+        options_text = numbered([supplier["name"] for supplier in people])
+        if more:
+            options_text += "\nThere are more matches; include more of the name to narrow it down."
         session = {
             "state": "awaiting_recipient_choice",
             "options": options,
             "topic": topic
         }
-        sessions[session_id] = session
+        await save_session(session_id, session)
         return {
             "status": "ambiguous",
             "message": f"I found multiple matches. Please choose one of the options below:\n{options_text}",
@@ -244,18 +715,19 @@ async def handle_new_request(session_id, raw_message):
     else:
         recipient = people[0]
 
-    user_emails_resp = supabase.table("user_emails").select("email").execute()
-    user_emails = [e["email"] for e in user_emails_resp.data]
-
     session = {"recipient": recipient, "topic": topic}
 
     if len(user_emails) > 1:
         session["state"] = "awaiting_user_email_choice"
         session["user_emails"] = user_emails
-        sessions[session_id] = session
+        # The recipient is settled, so keep writing the draft for after the sender is picked
+        pending_drafts[session_id] = (draft_task, held)
+        background_tasks.add(draft_task)
+        draft_task.add_done_callback(background_tasks.discard)
+        await save_session(session_id, session)
         return {
             "status": "awaiting_user_email_choice",
-            "message": f"Multiple sender emails found. Choose one:\n" + "\n".join([f"- {e}" for e in user_emails]),
+            "message": f"Multiple sender emails found. Choose one:\n{numbered(user_emails)}",
             "options": user_emails
         }
     elif len(user_emails) == 1:
@@ -263,12 +735,16 @@ async def handle_new_request(session_id, raw_message):
     else:
         return {"status": "no_email", "message": "No sender emails saved. Please add one."}
 
-    parsed = await generate_email_draft(recipient["name"], topic)
+    listener = draft_listener.get()
+    if listener:
+        held.release(listener)
+    parsed = await draft_task
     session.update({
         "state": "awaiting_confirmation",
-        "draft": parsed["message"]
+        "draft": parsed["message"],
+        "draft_subject": parsed["subject"]
     })
-    sessions[session_id] = session
+    await save_session(session_id, session)
 
     return {
         "status": "awaiting_confirmation",
@@ -276,41 +752,3 @@ async def handle_new_request(session_id, raw_message):
         "recipient": recipient["name"],
         "recipient_email": recipient["email"]
     }
-
-async def generate_email_draft(name: str, topic: str) -> dict:
-    prompt = f"""
-    Draft a short, professional, but friendly email to {name} about this topic: \"{topic}\".
-    Include a subject line at the top like this:
-    Subject: <your subject here>
-
-    Then add the email message starting with:
-    Message: <your message here>
-
-    Do not include any sign-off or sender name.
-    """
-
-    result = openai_client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You write emails that are clear and concise. No sign-off or sender name."},
-            {"role": "user", "content": prompt}
-        ]
-    )
-
-    response = result.choices[0].message.content.strip()
-    lines = response.splitlines()
-    subject = ""
-    message_lines = []
-    in_message = False
-
-    for line in lines:
-        if line.lower().startswith("subject:"):
-            subject = line[len("subject:"):].strip()
-        elif line.lower().startswith("message:"):
-            in_message = True
-            message_lines.append(line[len("message:"):].strip())
-        elif in_message:
-            message_lines.append(line.strip())
-
-    message = "\n".join(message_lines)
-    return {"subject": subject, "message": message}
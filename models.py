@@ -1,21 +1,43 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 from typing import List, Optional
 
 class Task(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
     id: Optional[str] = None
     title: str
     description: Optional[str] = None
     status: str = "pending"
 
 class Update(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
     date: str
     message: str
     engineer: Optional[str] = None
 
 class Project(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
     id: Optional[str] = None
     name: str
     description: str
-    phases: Optional[List[str]] = []
-    tasks: List[Task] = []
-    updates: List[Update] = []
+    phases: Optional[List[str]] = Field(default_factory=list)
+    tasks: List[Task] = Field(default_factory=list)
+    updates: List[Update] = Field(default_factory=list)
+
+# Structured outputs requested from GPT; every field is required, as strict JSON schemas demand.
+# extra="forbid" makes the generated schema carry additionalProperties: false and rejects stray keys.
+class ParsedCommand(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
+    recipient: str
+    subject: str
+    message: str
+
+class ExtractedRequest(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
+    recipient_name: str
+    recipient_email: str
+    topic: str
@@ -0,0 +1,6 @@
+-- Supplier lookups filter on name with a leading-wildcard ILIKE and on exact email.
+-- A trigram GIN index serves ILIKE '%...%' directly; a plain B-tree covers the email equality.
+create extension if not exists pg_trgm;
+
+create index if not exists suppliers_name_trgm on suppliers using gin (name gin_trgm_ops);
+create index if not exists suppliers_email_idx on suppliers (email);
@@ -0,0 +1,12 @@
+-- Ranked supplier name search for lookups made before the in-process supplier index has loaded.
+-- Both predicates are served by suppliers_name_trgm; substring hits keep parity with the old ILIKE query.
+create or replace function search_suppliers(q text)
+returns table (id suppliers.id%type, name text, email text, material text)
+language sql stable
+as $$
+    select s.id, s.name, s.email, s.material
+    from suppliers s
+    where s.name ilike '%' || q || '%' or s.name % q
+    order by similarity(s.name, q) desc
+    limit 10;
+$$;
@@ -0,0 +1,13 @@
+-- Let callers ask for one row past what they display, so they can tell when more matches exist.
+drop function if exists search_suppliers(text);
+
+create or replace function search_suppliers(q text, max_results int default 10)
+returns table (id suppliers.id%type, name text, email text, material text)
+language sql stable
+as $$
+    select s.id, s.name, s.email, s.material
+    from suppliers s
+    where s.name ilike '%' || q || '%' or s.name % q
+    order by similarity(s.name, q) desc
+    limit max_results;
+$$;
@@ -0,0 +1,104 @@
+import asyncio
+import os
+
+# clients.py builds the OpenAI client at import time, which needs a key but never makes a call here
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import pytest
+
+import main
+
+SESSION_ID = "session"
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Stub every side effect of handle_confirmation and record what it tried to do."""
+    calls = {"sent": [], "revised": [], "saved": []}
+
+    async def send_email(from_email, to_email, subject, body):
+        calls["sent"].append((from_email, to_email, subject, body))
+
+    async def revise_email_draft(session, instructions):
+        calls["revised"].append(instructions)
+        return {"subject": "Revised", "message": f"Revised: {instructions}"}
+
+    async def save_session(session_id, session):
+        calls["saved"].append(dict(session))
+
+    async def delete_session(session_id, session):
+        pass
+
+    async def get(key):
+        return None
+
+    monkeypatch.setattr(main, "send_email", send_email)
+    monkeypatch.setattr(main, "revise_email_draft", revise_email_draft)
+    monkeypatch.setattr(main, "save_session", save_session)
+    monkeypatch.setattr(main, "delete_session", delete_session)
+    monkeypatch.setattr(main.redis_client, "get", get)
+    return calls
+
+
+def make_session():
+    return {
+        "recipient": {"name": "Acme", "email": "sales@acme.test"},
+        "chosen_user_email": "me@example.test",
+        "topic": "pricing",
+        "draft": "Hello Acme",
+        "draft_subject": "Pricing",
+    }
+
+
+def reply(session, text):
+    return asyncio.run(main.handle_confirmation(SESSION_ID, text.strip().lower(), session, text.strip()))
+
+
+def test_yes_after_bare_no_sends(calls):
+    session = make_session()
+
+    asked = reply(session, "no")
+    sent = reply(session, "yes")
+
+    assert asked["message"] == "What would you like me to change?"
+    assert sent["status"] == "sent"
+    assert calls["sent"] == [("me@example.test", "sales@acme.test", "Pricing", "Hello Acme")]
+    assert calls["revised"] == []
+
+
+@pytest.mark.parametrize("text", ["yes", "go ahead", "Looks good, send it please"])
+def test_approval_sends(calls, text):
+    assert reply(make_session(), text)["status"] == "sent"
+
+
+@pytest.mark.parametrize("text", [
+    "change it so it doesn't mention the price",
+    "make it shorter and don't mention the deadline",
+    "edit: not so formal",
+    "yes but shorter",
+])
+def test_negated_instructions_are_revised(calls, text):
+    response = reply(make_session(), text)
+
+    assert calls["revised"] == [text]
+    assert calls["sent"] == []
+    assert response["message"] == f"Revised: {text}"
+
+
+def test_instructions_after_bare_no_are_revised(calls):
+    session = make_session()
+
+    reply(session, "no")
+    reply(session, "make it shorter and don't mention the deadline")
+
+    assert calls["revised"] == ["make it shorter and don't mention the deadline"]
+    assert session["draft"] == "Revised: make it shorter and don't mention the deadline"
+
+
+@pytest.mark.parametrize("text", ["no, don't send it yet", "ok but not yet", "don’t send"])
+def test_hold_neither_sends_nor_revises(calls, text):
+    response = reply(make_session(), text)
+
+    assert response["status"] == "awaiting_confirmation"
+    assert calls["sent"] == []
+    assert calls["revised"] == []